@@ -6,13 +6,19 @@ from datetime import datetime
 
 load_dotenv()
 
+SYNC_LIMIT = 30  # posts per page when checking for new timeline entries
+SESSION_DIR = os.path.expanduser('~/.cache/atrelay')
+
+_BSKY_SUFFIX = re.compile(r'\.bsky\.social$')
+_NONWORD = re.compile(r'[^A-Za-z0-9_]')
+_NEWLINES = re.compile(r'\r\n|\r|\n')
+_DID = re.compile(r'did:plc:[^/]+')
+_NICK_TRANS = str.maketrans({'.': '_', ' ': '_'})
+
 def sanitize(field: str) -> str:
-    field = re.sub(r'\.bsky\.social$', '', field)
-    field = field.replace('.', '_')
-    field = field.replace(' ', '_')
+    field = _BSKY_SUFFIX.sub('', field).translate(_NICK_TRANS)
     # strip out anything but letters, digits, and underscores
-    base = re.sub(r'[^A-Za-z0-9_]', '', field)
-    base = re.sub(r'_+$', '', base)
+    base = _NONWORD.sub('', field).rstrip('_')
     if not base:
         base = "_nohandle"
     if base[0].isdigit():
@@ -31,15 +37,21 @@ class AT:
         self.client = AsyncClient()
         self.handle = os.getenv('BSKY_HANDLE')
         self.password = os.getenv('BSKY_APP_PASSWORD')
+        self.session_path = os.path.join(SESSION_DIR, f"{self.handle}.session")
         self.profile = None
         self.cursor = None
         self.seen_posts = set()
         self.oldest = None
         self.posts = []
+        self.authors: Dict[str, Author] = {}  # did -> Author
         self.initialized = False
 
     async def initialize(self):
-        self.profile = await self.client.login(self.handle, self.password)
+        # persist new and refreshed sessions so restarts can skip the password login
+        self.client.on_session_change(self.save_session)
+        self.profile = await self.restore_session()
+        if not self.profile:
+            self.profile = await self.client.login(self.handle, self.password)
         # load initial timeline
         data = await self.client.get_timeline(limit=100)
         self.timeline = data.feed
@@ -47,9 +59,34 @@ class AT:
             self.add_fv(fv)
         self.initialized = True
 
+    async def restore_session(self):
+        try:
+            with open(self.session_path) as f:
+                session_string = f.read().strip()
+        except FileNotFoundError:
+            return None
+        except OSError:
+            logging.exception("Error reading saved session, logging in with password")
+            return None
+        try:
+            return await self.client.login(session_string=session_string)
+        except Exception:
+            logging.exception("Saved session rejected, logging in with password")
+            return None
+
+    async def save_session(self, event, session):
+        try:
+            os.makedirs(SESSION_DIR, exist_ok=True)
+            fd = os.open(self.session_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(session.export())
+        except OSError:
+            logging.exception("Error saving session")
+
     def add_fv(self, fv):
         post = self.add_post(fv.post)
-        if post and fv.reason:
+        # only reposts carry a reposting author, ignore other reasons such as pins
+        if post and fv.reason and fv.reason.py_type == 'app.bsky.feed.defs#reasonRepost':
             post._reason = fv.reason
         return post
 
@@ -57,6 +94,14 @@ class AT:
         if post.cid in self.seen_posts:
             return None
         post._at = datetime.fromisoformat(post.indexed_at.replace('Z', '+00:00'))
+        post._time_tag = post._at.strftime('%Y-%m-%dT%H:%M:%S.000Z')  # IRCv3 server-time
+        try:
+            post._body = self.format_body(post)
+        except Exception:
+            # one malformed post must not stop the timeline from loading or syncing
+            logging.exception(f"Error formatting post {post.uri}")
+            post._body = []
+        post._reason = None
         if self.oldest is None or post._at < self.oldest:
             self.oldest = post._at
         self.posts.append(post)
@@ -69,17 +114,17 @@ class AT:
 
         while True:
             try:
-                timeline = await self.client.get_timeline(limit=1, cursor=cursor)
-                cursor = None
+                timeline = await self.client.get_timeline(limit=SYNC_LIMIT, cursor=cursor)
+                cursor = timeline.cursor if timeline.feed else None
 
                 for fv in timeline.feed:
-                    # only continue if it was a new post
+                    # stop at the first post we already had, everything after it is old
                     post = self.add_fv(fv)
                     if post and self.oldest < post._at:
-                        cursor = timeline.cursor
                         new_posts.append(post)
                     else:
                         cursor = None
+                        break
 
             except Exception:
                 logging.exception("Error checking timeline")
@@ -102,12 +147,14 @@ class AT:
 
     def get_author(self, post) -> Author:
         # Get author from either repost reason or post author
-        author = getattr(getattr(post, '_reason', None), 'by', None) or post.author
-        return Author(
-            did=author.did,
-            handle=author.handle,
-            display_name=getattr(author, 'display_name', None)
-        )
+        author = post._reason.by if post._reason else post.author
+        if author.did not in self.authors:
+            self.authors[author.did] = Author(
+                did=author.did,
+                handle=author.handle,
+                display_name=author.display_name
+            )
+        return self.authors[author.did]
 
     async def format_post(self, post):
         lines = []
@@ -115,10 +162,8 @@ class AT:
         # handle replies based on context
         reply_ok = False
         if post.record.reply:
-            if hasattr(post.record.reply.parent, 'cid'):
-                parent_cid = post.record.reply.parent.cid
-                if parent_cid in self.seen_posts:
-                    reply_ok = True
+            if post.record.reply.parent.cid in self.seen_posts:
+                reply_ok = True
             if not reply_ok:
                 parent = await self.sync_post(post.record.reply.parent.uri)
                 if parent:
@@ -127,33 +172,38 @@ class AT:
                     lines.append(f"↩ {parent.author.display_name} (@{parent.author.handle}):")
                     lines.extend(f" | {line}" for line in parent_formatted)
 
-        logging.debug("Post data: %s", post.model_dump_json())
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Post data: %s", post.model_dump_json())
 
-        formatted_lines = self.format_record(post.record)
-        formatted_lines.extend(self.format_links(post, formatted_lines))
-        formatted_lines.extend(self.format_embed(post.embed, post.uri))
+        formatted_lines = post._body
     
         # Handle reposts showing original author and indented
-        if hasattr(post, '_reason') and hasattr(post._reason, 'by'):
+        if post._reason:
             lines.append(f"↻ {post.author.display_name} (@{post.author.handle}):")
             lines.extend(f" | {line}" for line in formatted_lines)
         else:
             lines.extend(formatted_lines)
-            if reply_ok:
+            if reply_ok and lines:
                 lines[0] = f"↪ {lines[0]}"
 
         return lines
 
+    def format_body(self, post):
+        # text, links and embeds only depend on the post itself, so render them once
+        lines = self.format_record(post.record)
+        lines.extend(self.format_links(post, lines))
+        lines.extend(self.format_embed(post.embed, post.uri))
+        return lines
+
     def format_links(self, post, lines):
         links = set()
         
         record = post.record
-        if hasattr(record, 'facets') and record.facets:
-            for facet in record.facets:
-                if facet.py_type == 'app.bsky.richtext.facet':
-                    for feature in facet.features:
-                        if feature.py_type == 'app.bsky.richtext.facet#link':
-                            links.add(feature.uri)
+        for facet in record.facets or ():
+            if facet.py_type == 'app.bsky.richtext.facet':
+                for feature in facet.features:
+                    if feature.py_type == 'app.bsky.richtext.facet#link':
+                        links.add(feature.uri)
 
         if post.embed:
             if 'external' in post.embed.py_type:
@@ -165,7 +215,7 @@ class AT:
         if not record.text:
             return []
         
-        lines = re.split(r'\r\n|\r|\n', record.text.strip())
+        lines = _NEWLINES.split(record.text.strip())
         lines = [line for line in lines if line.strip()]
         return lines
 
@@ -176,20 +226,22 @@ class AT:
         if e.py_type == 'app.bsky.embed.images#view':
             lines = []
             for x in e.images:
-                alt_text = f"{x.alt.replace('\n',' ').strip()} " if getattr(x, 'alt', None) else ""
+                alt = x.alt.replace('\n', ' ').strip()
+                alt_text = f"{alt} " if alt else ""
                 alt_text = alt_text[:47] + "..." if len(alt_text) > 50 else alt_text
                 lines.append(f"📷 {alt_text}{x.fullsize or x.thumb} ")
             return lines
         elif e.py_type == 'app.bsky.embed.record#view':
-            if hasattr(e.record, 'value'):
+            if e.record.py_type == 'app.bsky.embed.record#viewRecord':
                 formatted_lines = self.format_record(e.record.value)
                 formatted_lines.extend(self.format_embed(e.record.value.embed, e.record.uri))
                 lines = [f"💬 {e.record.author.display_name} (@{e.record.author.handle}):"]
                 lines.extend(f" | {line}" for line in formatted_lines)
                 return lines
         elif e.py_type == 'app.bsky.embed.video#view':
-            alt_text = f"{e.alt.replace('\n',' ').strip()} " if getattr(e, 'alt', None) else ""
-            did_match = re.search(r'did:plc:[^/]+', uri)
+            alt = (e.alt or '').replace('\n', ' ').strip()
+            alt_text = f"{alt} " if alt else ""
+            did_match = _DID.search(uri)
             if did_match and e.cid:
                 did = did_match.group(0)
                 video_url = f"https://atproto-browser.vercel.app/blob/{did}/{e.cid}"
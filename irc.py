@@ -1,8 +1,18 @@
 import asyncio, logging, os
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Set, Union
 from at import AT, Author
 
 SYNC_RATE = 30
+POST_QUEUE_SIZE = 1024
+READ_SIZE = 4096
+CLOSE_TIMEOUT = 5  # seconds to wait for a closing socket before aborting it
+MAX_LINE = 8703  # 8191 bytes of tags + 512 byte message, per IRCv3 message-tags
+CAPABILITIES = ('message-tags', 'batch')
+HISTORY_BATCH = 'history'
+CRLF = b'\r\n'
+
+# IRCv3 message-tags value escaping
+_TAG_ESCAPES = str.maketrans({';': '\\:', ' ': '\\s', '\\': '\\\\', '\r': '\\r', '\n': '\\n'})
 
 class IRC:
     def __init__(self, at: AT, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, version: str = "0.0.0"):
@@ -18,11 +28,14 @@ class IRC:
 
         self.author_nicks: Dict[str, str] = {}  # handle -> nick
         self.authors: Dict[str, Author] = {}    # nick -> Author object
-        self.joined_authors: Dict[str, bool] = {}  # nick -> whether they've joined #timeline
+        self.joined_authors: Set[str] = set()    # nicks that have joined #timeline
+        self._names_cache: Optional[List[str]] = None  # 353 replies, rebuilt when nicks change
 
         self.addr = writer.get_extra_info('peername')
         logging.info(f"New connection from {self.addr}")
         self.server_name = os.getenv('IRC_SERVER_NAME', 'bridge.local')
+        self._srvprefix = f":{self.server_name}"
+        self._hostmask = f"!~@{os.getenv('BSKY_HANDLE')}"
 
         self.capabilities = set()
         self.cap_negotiating = False
@@ -32,27 +45,58 @@ class IRC:
         self.got_user = False
         self.joined_timeline = False
 
+        self._outbuf = bytearray()
+        self._postq: asyncio.Queue = asyncio.Queue(maxsize=POST_QUEUE_SIZE)
+        self._post_task: Optional[asyncio.Task] = None
+
     async def handle_connection(self):
         try:
             self.send("NOTICE * :Welcome to the Bluesky IRC Bridge, JOIN #timeline")
             
+            pending = b''
+            overflow = False
             while self.running:
                 try:
-                    line = await self.reader.readline()
-                    if not line:  # EOF
-                        break
-                    decoded = line.decode('utf-8', 'ignore').strip()
-                    logging.debug(f"← {self.addr}: {decoded}")
-                    await self.handle_line(decoded)
+                    await self.flush()
+                    data = await self.reader.read(READ_SIZE)
                 except ConnectionError:
                     logging.warning(f"Connection lost from {self.addr}")
                     break
-                except Exception as e:
-                    logging.exception(f"Error handling line: {e}")
+
+                if data:
+                    # a read may carry several lines, keep any partial one for next time
+                    lines = (pending + data).split(b'\n')
+                    pending = lines.pop()
+                else:  # EOF, an unterminated last line is still handled
+                    lines = [pending] if pending else []
+                    pending = b''
+                if overflow and lines:
+                    lines.pop(0)  # tail end of a line that was already dropped
+                    overflow = False
+                if len(pending) > MAX_LINE:
+                    logging.warning(f"Dropping oversized line from {self.addr}")
+                    pending = b''
+                    overflow = True
+
+                for line in lines:
+                    if not self.running:
+                        break
+                    if len(line) > MAX_LINE:
+                        logging.warning(f"Dropping oversized line from {self.addr}")
+                        continue
+                    decoded = line.decode('utf-8', 'ignore').strip()
+                    logging.debug("← %s: %s", self.addr, decoded)
+                    try:
+                        await self.handle_line(decoded)
+                    except Exception as e:
+                        logging.exception(f"Error handling line: {e}")
+                if not data:
+                    break
         finally:
             logging.info(f"Connection closed from {self.addr}")
-            self.writer.close()
-            await self.writer.wait_closed()
+            if self._post_task:
+                self._post_task.cancel()
+            await self.close()  # also sends replies to the last lines read, e.g. before QUIT
 
     async def handle_line(self, line):
         parts = line.split()
@@ -70,17 +114,21 @@ class IRC:
         elif cmd == 'NICK':
             old_nick = self.nick
             self.nick = parts[1] if len(parts) > 1 else 'anon'
+            self._names_cache = None
             self.got_nick = True
             logging.info(f"Client {self.addr} nick change: {old_nick} → {self.nick}")
-            if self.got_user:
+            if self.got_user and not self.cap_negotiating:
                 await self.finish_registration()
         elif cmd == 'USER':
             self.got_user = True
-            if self.got_nick:
+            if self.got_nick and not self.cap_negotiating:
                 await self.finish_registration()
         elif cmd == 'PRIVMSG' and self.joined_timeline:
             if len(parts) > 2 and parts[1] == '#timeline':
-                msg = line.split(' ', 2)[2][1:] if len(line.split(' ', 2)) > 2 else ''
+                sp = line.split(' ', 2)
+                msg = sp[2] if len(sp) > 2 else ''
+                if msg.startswith(':'):
+                    msg = msg[1:]
                 await self.parse_timeline_cmd(msg)
         elif cmd == 'QUIT':
             self.running = False
@@ -96,17 +144,25 @@ class IRC:
             return
             
         self.registered = True
-        self.send(f":{self.server_name} 001 {self.nick} :Welcome to the Bluesky IRC Bridge, {self.nick}")
-        self.send(f":{self.server_name} 002 {self.nick} :Running ATRelay IRC Bridge")
-        self.send(f":{self.server_name} 003 {self.nick} :This server was created just now")
-        self.send(f":{self.server_name} 004 {self.nick} {self.server_name} {self.version} o o")
+        welcome = (
+            f"001 {self.nick} :Welcome to the Bluesky IRC Bridge, {self.nick}",
+            f"002 {self.nick} :Running ATRelay IRC Bridge",
+            f"003 {self.nick} :This server was created just now",
+            f"004 {self.nick} {self.server_name} {self.version} o o",
+        )
+        for line in welcome:
+            self.send(f"{self._srvprefix} {line}")
 
         logging.info(f"Client {self.addr} auto-joined as {self.nick} to #timeline")
         self.joined_timeline = True
-        self.send(f":{self.nick}!~@{os.getenv('BSKY_HANDLE')} JOIN #timeline")
-        self.send(f":{self.server_name} MODE #timeline +o {self.nick}")
+        self.send(f":{self.nick}{self._hostmask} JOIN #timeline")
+        self.send(f"{self._srvprefix} MODE #timeline +o {self.nick}")
         self.send(f":localhost 332 {self.nick} #timeline :Bluesky AT Bridge")
-        await self.send_history()
+        try:
+            await self.send_history()
+        finally:
+            # live posts only start flowing once the replay is fully buffered
+            self._post_task = asyncio.create_task(self._post_loop())
 
     async def handle_capability(self, args):
         if not args:
@@ -115,14 +171,22 @@ class IRC:
         subcmd = args[0].upper()
         if subcmd == 'LS':
             self.cap_negotiating = True
-            self.send("CAP * LS :message-tags")
+            self.send(f"CAP * LS :{' '.join(CAPABILITIES)}")
         elif subcmd == 'REQ' and len(args) > 1:
-            requested = args[1].lstrip(':').split()
-            if 'message-tags' in requested:
-                self.capabilities.add('message-tags')
-                self.send("CAP * ACK :message-tags")
+            # a REQ without LS also suspends registration until END
+            if not self.registered:
+                self.cap_negotiating = True
+            requested = ' '.join(args[1:]).lstrip(':').split()
+            if all(cap in CAPABILITIES for cap in requested):
+                self.capabilities.update(requested)
+                self.send(f"CAP * ACK :{' '.join(requested)}")
+            else:
+                self.send(f"CAP * NAK :{' '.join(requested)}")
         elif subcmd == 'END':
             self.cap_negotiating = False
+            # registration waits for negotiation so the replay can use the caps
+            if self.got_nick and self.got_user:
+                await self.finish_registration()
 
     async def parse_timeline_cmd(self, msg: str) -> None:
         m = msg.strip().split()
@@ -136,104 +200,163 @@ class IRC:
         else:
             self.send_channel("Commands: !echo <text>")
 
-    def send(self, msg: str):
+    def send(self, msg: Union[str, bytes]):
+        # callers that repeat a prefix across lines can pass pre-encoded bytes
+        if isinstance(msg, str):
+            logging.debug("→ %s: %s", self.addr, msg)
+            msg = msg.encode()
+        elif logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("→ %s: %s", self.addr, msg.decode(errors='replace'))
+        self._outbuf += msg
+        self._outbuf += CRLF
+
+    async def flush(self, drain: bool = True):
+        # coalesce everything queued by send() into a single write, then apply
+        # back-pressure once per burst so slow clients can't grow the buffer unbounded
+        if not self._outbuf:
+            return
+        data = bytes(self._outbuf)
+        self._outbuf.clear()
         try:
-            logging.debug(f"→ {self.addr}: {msg}")
-            self.writer.write(f"{msg}\r\n".encode())
+            self.writer.write(data)
+            if drain:
+                await self.writer.drain()
         except Exception as e:
             logging.error(f"Error sending message: {e}")
 
-    def send_tagged(self, msg: str, tags: Dict[str, str] = None):
+    async def close(self):
+        # a client that stopped reading would block drain() and wait_closed() forever
+        await self.flush(drain=False)
+        self.writer.close()
+        try:
+            await asyncio.wait_for(asyncio.shield(self.writer.wait_closed()), CLOSE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.writer.transport.abort()
+
+    def tag_prefix(self, tags: Dict[str, str] = None) -> str:
         if tags and 'message-tags' in self.capabilities:
-            escaped_tags = {
-                k: v.replace('\\', '\\\\').replace(';', '\\:').replace(' ', '\\s')
-                for k, v in tags.items()
-            }
-            tag_str = ';'.join(f"{k}={escaped_tags[k]}" for k, v in tags.items())
-            msg = f"@{tag_str} {msg}"
-        self.send(msg)
+            tag_str = ';'.join(f"{k}={v.translate(_TAG_ESCAPES)}" for k, v in tags.items())
+            return f"@{tag_str} "
+        return ""
 
     def send_channel(self, msg: str):
         if self.nick:
-            self.send(f":{self.nick}!~@{os.getenv('BSKY_HANDLE')} PRIVMSG #timeline :{msg}")
+            self.send(f":{self.nick}{self._hostmask} PRIVMSG #timeline :{msg}")
 
     def ensure_author_joined(self, author: Author):
-        if not self.joined_authors.get(author.nick):
+        if author.nick not in self.joined_authors:
             self.send(f":{author.nick}!~@{author.handle} JOIN #timeline")
-            self.joined_authors[author.nick] = True
+            self.joined_authors.add(author.nick)
             self.authors[author.nick] = author
             self.author_nicks[author.handle] = author.nick
+            self._names_cache = None
 
     async def handle_who(self, target):
         if target != "#timeline":
             return
         
-        self.send(f":{self.server_name} 352 {self.nick} #timeline * {self.server_name} {self.nick} H@ :0 {self.nick}")
+        prefix = f"{self._srvprefix} 352 {self.nick} #timeline *"
+        self.send(f"{prefix} {self.server_name} {self.nick} H@ :0 {self.nick}")
         
         for nick, author in self.authors.items():
             flags = "H"  # H for "here"
-            self.send(f":{self.server_name} 352 {self.nick} #timeline * {author.handle} {nick} {flags} :0 {author.display_name or author.handle}")
-        self.send(f":{self.server_name} 315 {self.nick} #timeline :End of WHO list")
+            self.send(f"{prefix} {author.handle} {nick} {flags} :0 {author.display_name or author.handle}")
+        self.send(f"{self._srvprefix} 315 {self.nick} #timeline :End of WHO list")
 
     async def handle_whois(self, nick):
         author = self.authors.get(nick)
         if not author:
-            self.send(f":{self.server_name} 401 {self.nick} {nick} :No such nick")
+            self.send(f"{self._srvprefix} 401 {self.nick} {nick} :No such nick")
             return
         
-        self.send(f":{self.server_name} 311 {self.nick} {nick} ~ {author.handle} * :{author.display_name or author.handle}")
-        self.send(f":{self.server_name} 319 {self.nick} {nick} :#timeline")
+        self.send(f"{self._srvprefix} 311 {self.nick} {nick} ~ {author.handle} * :{author.display_name or author.handle}")
+        self.send(f"{self._srvprefix} 319 {self.nick} {nick} :#timeline")
         
-        self.send(f":{self.server_name} 320 {self.nick} {nick} :Bluesky ID: {author.did}")
-        self.send(f":{self.server_name} 320 {self.nick} {nick} :Handle: @{author.handle}")
+        self.send(f"{self._srvprefix} 320 {self.nick} {nick} :Bluesky ID: {author.did}")
+        self.send(f"{self._srvprefix} 320 {self.nick} {nick} :Handle: @{author.handle}")
         if author.display_name:
-            self.send(f":{self.server_name} 320 {self.nick} {nick} :Display Name: {author.display_name}")
+            self.send(f"{self._srvprefix} 320 {self.nick} {nick} :Display Name: {author.display_name}")
         
-        self.send(f":{self.server_name} 318 {self.nick} {nick} :End of WHOIS list")
+        self.send(f"{self._srvprefix} 318 {self.nick} {nick} :End of WHOIS list")
 
     async def handle_names(self, target):
         if target != "#timeline":
             return
         
-        names = [f"@{self.nick}"]
-        names.extend(list(self.authors.keys()))
-        chunk_size = 20
-        for i in range(0, len(names), chunk_size):
-            chunk = names[i:i + chunk_size]
-            self.send(f":{self.server_name} 353 {self.nick} = #timeline :{' '.join(chunk)}")
-        self.send(f":{self.server_name} 366 {self.nick} #timeline :End of NAMES list")
+        if self._names_cache is None:
+            names = [f"@{self.nick}"]
+            names.extend(self.authors.keys())
+            prefix = f"{self._srvprefix} 353 {self.nick} = #timeline :"
+            chunk_size = 20
+            self._names_cache = [
+                prefix + ' '.join(names[i:i + chunk_size])
+                for i in range(0, len(names), chunk_size)
+            ]
+        for reply in self._names_cache:
+            self.send(reply)
+        self.send(f"{self._srvprefix} 366 {self.nick} #timeline :End of NAMES list")
 
     async def send_history(self):
         if not self.at.posts:
             self.send_channel("No posts.")
             return
-        for post in sorted(self.at.posts, key=lambda p: p._at):
-            await self.send_post_as_author(post)
+        # let the client treat the replay as one unit when it supports batches
+        batch = HISTORY_BATCH if {'batch', 'message-tags'} <= self.capabilities else None
+        if batch:
+            self.send(f"{self._srvprefix} BATCH +{batch} chathistory #timeline")
+        try:
+            for post in sorted(self.at.posts, key=lambda p: p._at):
+                await self.send_post_as_author(post, batch)
+        finally:
+            if batch:
+                self.send(f"{self._srvprefix} BATCH -{batch}")
+
+    def queue_post(self, post):
+        # posts synced before the client joined are part of its history replay
+        if not self.joined_timeline:
+            return
+        # never block the caller on a slow client, drop its oldest pending post instead
+        if self._postq.full():
+            self._postq.get_nowait()
+            logging.warning(f"Post queue full for {self.addr}, dropping oldest post")
+        self._postq.put_nowait(post)
+
+    async def _post_loop(self):
+        while True:
+            post = await self._postq.get()
+            try:
+                await self.send_post_as_author(post)
+                await self.flush()
+            except Exception as e:
+                logging.exception(f"Error sending post: {e}")
 
-    async def send_post_as_author(self, post):
+    async def send_post_as_author(self, post, batch: Optional[str] = None):
         author = self.at.get_author(post)
         self.ensure_author_joined(author)
 
         tags = {
-            'time': post._at.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            'time': post._time_tag
         }
+        if batch:
+            tags['batch'] = batch
 
+        # every line of the post shares the same tags and source, encode them once
+        prefix = f"{self.tag_prefix(tags)}:{author.nick}!~@{self.server_name} PRIVMSG #timeline :".encode()
         lines = await self.at.format_post(post)
         for line in lines:
-            self.send_tagged(f":{author.nick}!~@{self.server_name} PRIVMSG #timeline :{line}", tags)
+            self.send(prefix + line.encode())
 
     async def handle_mode(self, target, args):
         if target == "#timeline":
-            self.send(f":{self.server_name} 324 {self.nick} #timeline +nt")
+            self.send(f"{self._srvprefix} 324 {self.nick} #timeline +nt")
         elif target == self.nick:
-            self.send(f":{self.server_name} 221 {self.nick} +")
+            self.send(f"{self._srvprefix} 221 {self.nick} +")
 
     async def shutdown(self):
         self.running = False
         if self.writer:
             try:
                 self.send("ERROR :Server shutting down")
-                self.writer.close()
-                await self.writer.wait_closed()
+                await self.close()
             except:
                 pass
\ No newline at end of file
@@ -3,6 +3,8 @@ from at import AT
 from irc import IRC
 
 VERSION = "0.1.0"
+MAX_CLIENTS = 64
+BACKLOG = 128
 
 class IRCServer:
     def __init__(self, at: AT, host: str, port: int):
@@ -15,6 +17,15 @@ class IRCServer:
         self._sync_task = None
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if len(self.clients) >= MAX_CLIENTS:
+            logging.warning(f"Rejecting connection from {writer.get_extra_info('peername')}: too many clients")
+            writer.write(b"ERROR :Too many connections\r\n")
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            return
         client = IRC(self.at, reader, writer, version=self.version)
         self.clients.add(client)
         try:
@@ -28,7 +39,7 @@ class IRCServer:
                 new_posts = await self.at.sync_timeline()
                 for client in list(self.clients):
                     for post in new_posts:
-                        await client.send_post_as_author(post)
+                        client.queue_post(post)
                 await asyncio.sleep(30)
             except asyncio.CancelledError:
                 break
@@ -37,7 +48,8 @@ class IRCServer:
         self.server = await asyncio.start_server(
             self.handle_client,
             self.host,
-            self.port
+            self.port,
+            backlog=BACKLOG
         )
         self._sync_task = asyncio.create_task(self.sync_timeline())
         
@@ -94,4 +106,9 @@ async def main():
         logging.info("Server shutdown complete")
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
\ No newline at end of file